@@ -1,24 +1,24 @@
-from PIL import Image
 import quad_tree_compression as qtc
-import numpy as np
+from image_saving import BackgroundImageSaver
 from tqdm import tqdm
 
 
 def animate_subdivision(image_path: str, iteration_counts: list):
-    image = Image.open(image_path)
-    image_data = np.array(image, dtype=np.uint8)
+    image_data = qtc.load_image_data(image_path)
 
     compressor = qtc.ImageCompressor(image_data)
 
-    last_iteration_count = 0
-    frame = 0
-    for iteration_count in tqdm(iteration_counts):
-        frame += 1
-        compressor.add_detail(iteration_count - last_iteration_count)
-        last_iteration_count = iteration_count
-
-        compressed_image = compressor.draw()
-        Image.fromarray(compressed_image).save(f"animation/frame_{frame:0>4}.jpg")
+    # The frames are encoded and written on background threads while the next frame is being computed.
+    with BackgroundImageSaver() as image_saver:
+        last_iteration_count = 0
+        frame = 0
+        for iteration_count in tqdm(iteration_counts):
+            frame += 1
+            compressor.add_detail(iteration_count - last_iteration_count)
+            last_iteration_count = iteration_count
+
+            compressed_image = compressor.draw()
+            image_saver.save(compressed_image, f"animation/frame_{frame:0>4}.jpg")
 
 
 # Command to convert the frames to a video:
@@ -2,10 +2,13 @@
 from pathlib import Path
 
 # Entropy calculation
-from skimage.filters.rank import entropy as sk_entropy
-from skimage.morphology import disk as sk_disk
-from skimage.exposure import histogram as sk_histogram
-from skimage.color import rgb2gray
+# (scikit-image is imported where it is needed, as importing it takes a noticeable amount of time)
+try:
+    # Optional: speeds up the computation of the mean local entropy
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
 
 # Image processing and maths
 import numpy as np
@@ -15,23 +18,36 @@ import quad_tree_compression as qtc
 
 # "Virtual files" for estimating size of the images
 from io import BytesIO
+from functools import lru_cache
 
 # String formatting
 from tabulate import tabulate
 
+# Saving the output images in the background
+from image_saving import BackgroundImageSaver
 
-def get_image_file_size(image: Image, format: str = "png"):
+
+@lru_cache(maxsize=None)
+def get_image_file_size(image_path: str, format: str = "png"):
+    # Encoding large images takes a long time, so the result is cached for repeated benchmarks of the same image.
+    image = Image.open(image_path)
     stream = BytesIO()
     image.save(stream, format, quality=90)
     return len(stream.getvalue())
 
 
 def mean_squared_error(image_a: np.array, image_b: np.array) -> float:
-    image_a = image_a.astype(np.single)
-    image_b = image_b.astype(np.single)
-
-    mse_per_channel = np.mean((image_a - image_b) ** 2, axis=(0, 1))
-    mse = np.sum(mse_per_channel) / 3
+    # The difference of two uint8 images fits into int16,
+    # which moves far fewer bytes than converting both images to floats.
+    # Subtracting with dtype=int16 widens the values on the fly instead of copying both images first.
+    difference = np.subtract(image_a, image_b, dtype=np.int16).reshape(-1)
+
+    # As every channel has the same number of pixels, the mean over all values
+    # equals the average of the per-channel MSEs.
+    # einsum squares the differences and adds them up in int64 in a single pass,
+    # without storing the squares in a temporary array (the sum could overflow int32 on large images).
+    squared_error_sum = np.einsum("i,i->", difference, difference, dtype=np.int64)
+    mse = squared_error_sum / difference.size
     return float(mse)
 
 
@@ -40,10 +56,9 @@ def root_mean_squared_error(image_a: np.array, image_b: np.array) -> float:
 
 
 def mean_average_error(image_a: np.array, image_b: np.array) -> float:
-    image_a = image_a.astype(np.single)
-    image_b = image_b.astype(np.single)
-    mae_per_channel = np.mean(np.abs(image_a - image_b), axis=(0, 1))
-    mae = np.sum(mae_per_channel) / 3
+    absolute_difference = np.subtract(image_a, image_b, dtype=np.int16)
+    np.abs(absolute_difference, out=absolute_difference)
+    mae = absolute_difference.sum(dtype=np.int64) / absolute_difference.size
     return float(mae)
 
 
@@ -51,17 +66,102 @@ def compute_image_similarity(image_a: np.array, image_b: np.array) -> float:
     return 1 - mean_average_error(image_a, image_b) / 255
 
 
+if NUMBA_AVAILABLE:
+    @njit(parallel=True, cache=True)
+    def _sum_local_entropy(gray: np.array, radius: int) -> float:
+        """ Computes the sum of the local entropy of each pixel of a uint8 image over a disk footprint.
+
+        Equivalent to summing skimage.filters.rank.entropy(gray, disk(radius)), but instead of building a
+        histogram per pixel, each row slides one histogram along, only adding and removing the pixels at the
+        left and right edges of the disk. The entropy is maintained incrementally using the identity
+        -sum(p * log2(p)) = log2(n) - sum(c * log2(c)) / n, where c are the counts and n is their sum.
+        """
+        height, width = gray.shape
+
+        # Half width of each row of the disk (pixels with dx^2 + dy^2 <= radius^2)
+        half_widths = np.empty(2 * radius + 1, dtype=np.int64)
+        for dy in range(-radius, radius + 1):
+            half_widths[dy + radius] = int(math.sqrt(radius * radius - dy * dy))
+
+        max_count = np.sum(2 * half_widths + 1)
+        count_log2_count = np.zeros(max_count + 1)
+        for count in range(1, max_count + 1):
+            count_log2_count[count] = count * math.log2(count)
+
+        row_sums = np.zeros(height)
+        for y in prange(height):
+            histogram = np.zeros(256, dtype=np.int64)
+            pixel_count = 0
+            weighted_sum = 0.0
+
+            # Fill the histogram with the footprint of the first pixel of the row
+            for dy in range(-radius, radius + 1):
+                row = y + dy
+                if row < 0 or row >= height:
+                    continue
+                for column in range(min(half_widths[dy + radius] + 1, width)):
+                    value = gray[row, column]
+                    count = histogram[value]
+                    weighted_sum += count_log2_count[count + 1] - count_log2_count[count]
+                    histogram[value] = count + 1
+                    pixel_count += 1
+
+            row_sum = math.log2(pixel_count) - weighted_sum / pixel_count
+
+            for x in range(1, width):
+                for dy in range(-radius, radius + 1):
+                    row = y + dy
+                    if row < 0 or row >= height:
+                        continue
+                    half_width = half_widths[dy + radius]
+
+                    # Pixel leaving the footprint
+                    column = x - half_width - 1
+                    if column >= 0:
+                        value = gray[row, column]
+                        count = histogram[value]
+                        weighted_sum += count_log2_count[count - 1] - count_log2_count[count]
+                        histogram[value] = count - 1
+                        pixel_count -= 1
+
+                    # Pixel entering the footprint
+                    column = x + half_width
+                    if column < width:
+                        value = gray[row, column]
+                        count = histogram[value]
+                        weighted_sum += count_log2_count[count + 1] - count_log2_count[count]
+                        histogram[value] = count + 1
+                        pixel_count += 1
+
+                row_sum += math.log2(pixel_count) - weighted_sum / pixel_count
+            row_sums[y] = row_sum
+
+        return row_sums.sum()
+
+
 def compute_mean_local_entropy(image: np.array, radius=5) -> float:
+    from skimage.color import rgb2gray
     gray = (rgb2gray(image) * 255).astype(np.uint8)
+
+    if NUMBA_AVAILABLE:
+        # Only the mean is needed, so the local entropy of each pixel does not have to be stored.
+        return float(_sum_local_entropy(gray, radius) / gray.size)
+
+    from skimage.filters.rank import entropy as sk_entropy
+    from skimage.morphology import disk as sk_disk
     local_entropy = sk_entropy(gray, sk_disk(radius))
     entropy = np.mean(local_entropy)
     return float(entropy)
 
 
 def compute_channel_histogram_entropy(image_channel: np.array) -> float:
-    histogram, _ = sk_histogram(image_channel, nbins=256, source_range="dtype")
-    relative_occurrence = histogram / histogram.sum()
-    return -(relative_occurrence * np.ma.log2(relative_occurrence)).sum()
+    histogram = np.bincount(image_channel.ravel(), minlength=256)
+    # Empty bins do not contribute to the entropy (0 * log(0) is defined as 0).
+    counts = histogram[histogram > 0]
+    pixel_count = counts.sum()
+    # With p = c / n: -sum(p * log2(p)) = log2(n) - sum(c * log2(c)) / n
+    # This works on the integer counts directly instead of first dividing every bin by n.
+    return float(math.log2(pixel_count) - (counts * np.log2(counts)).sum() / pixel_count)
 
 
 def compute_histogram_entropy(image: np.array) -> float:
@@ -77,18 +177,18 @@ def benchmark_image(image_path: str, iteration_counts: list, tablefmt="simple"):
     print(title)
     print("=" * len(title))
 
-    image = Image.open(image_path)
-    image_data = np.array(image, dtype=np.uint8)
+    image_data = qtc.load_image_data(image_path)
+    height, width, _ = image_data.shape
 
     print()
     print(tabulate([
-        ["Width", image.width],
-        ["Height", image.height],
-        ["Resolution", f"{image.width * image.height / 1_000_000 :,.1f}MP"],
+        ["Width", width],
+        ["Height", height],
+        ["Resolution", f"{width * height / 1_000_000 :,.1f}MP"],
     ], stralign="right", numalign="right", tablefmt=tablefmt))
 
-    png_size = get_image_file_size(image, "png")
-    jpg_size = get_image_file_size(image, "jpeg")
+    png_size = get_image_file_size(image_path, "png")
+    jpg_size = get_image_file_size(image_path, "jpeg")
 
     print()
     print(tabulate([
@@ -107,39 +207,47 @@ def benchmark_image(image_path: str, iteration_counts: list, tablefmt="simple"):
 
     compressor = qtc.ImageCompressor(image_data)
 
-    last_iteration_count = 0
-    results_table = []
-    for iteration_count in iteration_counts:
-        compressor.add_detail(iteration_count - last_iteration_count)
-        last_iteration_count = iteration_count
-
-        compressed_data = compressor.encode_to_binary()
-        with open(f"output/{image_name}_{iteration_count}_qt.qid", "wb") as file:
-            file.write(compressed_data)
-
-        compressed_size = len(compressed_data)
-        compressed_image = compressor.draw()
-        Image.fromarray(compressed_image).save(f"output/{image_name}_{iteration_count}.jpg")
-
-        error = mean_average_error(image_data, compressed_image)
-        size_reduction_png = (png_size - compressed_size) / png_size
-        size_reduction_jpg = (jpg_size - compressed_size) / jpg_size
-        compression_factor_png = png_size / compressed_size
-        compression_factor_jpg = jpg_size / compressed_size
-
-        results_table.append([
-            iteration_count,
-            f"{(compressed_size / 1000):,.2f}",
-            f"{error:.2f}",
-            f"{(size_reduction_png * 100):.2f}",
-            f"{(size_reduction_jpg * 100):.2f}",
-            f"{compression_factor_png:.2f}",
-            f"{compression_factor_jpg:.2f}"
-        ])
+    # Encoding and writing the output images runs on background threads,
+    # so that it overlaps with the compression of the next iteration count.
+    with BackgroundImageSaver() as image_saver:
+        last_iteration_count = 0
+        results_table = []
+        for iteration_count in iteration_counts:
+            compressor.add_detail(iteration_count - last_iteration_count)
+            last_iteration_count = iteration_count
+
+            compressed_data = compressor.encode_to_binary()
+            with open(f"output/{image_name}_{iteration_count}_qt.qid", "wb") as file:
+                file.write(compressed_data)
+
+            compressed_size = len(compressed_data)
+            # Size of the binary representation before the general-purpose compression
+            uncompressed_size = compressor.get_uncompressed_binary_size()
+            compressed_image = compressor.draw()
+            # draw() returns a new array, so it is safe to save it while the compressor continues.
+            image_saver.save(compressed_image, f"output/{image_name}_{iteration_count}.jpg")
+
+            error = mean_average_error(image_data, compressed_image)
+            size_reduction_png = (png_size - compressed_size) / png_size
+            size_reduction_jpg = (jpg_size - compressed_size) / jpg_size
+            compression_factor_png = png_size / compressed_size
+            compression_factor_jpg = jpg_size / compressed_size
+
+            results_table.append([
+                iteration_count,
+                f"{(uncompressed_size / 1000):,.2f}",
+                f"{(compressed_size / 1000):,.2f}",
+                f"{error:.2f}",
+                f"{(size_reduction_png * 100):.2f}",
+                f"{(size_reduction_jpg * 100):.2f}",
+                f"{compression_factor_png:.2f}",
+                f"{compression_factor_jpg:.2f}"
+            ])
 
     print()
     print(tabulate(results_table, headers=[
         "Iterations",
+        "Uncompressed\nSize (KB)",
         "Compressed\nSize (KB)",
         "Mean Average\nError",
         "Size Reduction\nPNG (%)",
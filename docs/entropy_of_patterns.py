@@ -1,7 +1,6 @@
 from skimage.io import imshow
 from skimage.filters.rank import entropy as sk_entropy
 from skimage.morphology import disk as sk_disk
-from skimage.exposure import histogram as sk_histogram
 from skimage.color import rgb2gray
 
 import matplotlib.pyplot as plt
@@ -9,9 +8,11 @@ import numpy as np
 
 
 def compute_channel_histogram_entropy(image_channel: np.array) -> float:
-    histogram, _ = sk_histogram(image_channel, nbins=256, source_range="dtype")
+    histogram = np.bincount(image_channel.ravel(), minlength=256)
     relative_occurrence = histogram / histogram.sum()
-    return -(relative_occurrence * np.ma.log2(relative_occurrence)).sum()
+    # Empty bins do not contribute to the entropy (0 * log(0) is defined as 0).
+    relative_occurrence = relative_occurrence[relative_occurrence > 0]
+    return float(-(relative_occurrence * np.log2(relative_occurrence)).sum())
 
 
 np.random.seed(100)
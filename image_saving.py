@@ -0,0 +1,47 @@
+""" Helper for the benchmark and animation scripts: saves images on background threads. """
+
+from PIL import Image
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+
+
+class BackgroundImageSaver:
+    """ Encodes and writes images on background threads (Pillow releases the GIL while encoding),
+    so that saving an image overlaps with computing the next one.
+
+    Use as a context manager: leaving the with block waits for the remaining saves and raises
+    the exceptions of failed saves.
+    """
+
+    def __init__(self, max_workers: int = 2):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        # Each pending save holds on to a full copy of the image (and Pillow makes another one while encoding),
+        # so no more images are queued than can be saved at the same time.
+        self._max_pending_saves = max_workers
+        self._pending_saves = deque()
+
+    def save(self, image_data: np.array, path: str):
+        """ Saves the image in the background. The caller must not modify image_data afterwards.
+        Blocks while too many images are still waiting to be saved.
+        """
+        if len(self._pending_saves) >= self._max_pending_saves:
+            self._pending_saves.popleft().result()
+
+        self._pending_saves.append(self._executor.submit(self._save_image, image_data, path))
+
+    @staticmethod
+    def _save_image(image_data: np.array, path: str):
+        Image.fromarray(image_data).save(path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._executor.shutdown(wait=True)
+
+        if exc_type is None:
+            # Raises the exceptions of failed saves.
+            for save in self._pending_saves:
+                save.result()
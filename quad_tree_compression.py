@@ -3,21 +3,114 @@ import numpy as np
 from PIL import Image
 import math
 
-from sortedcontainers import SortedListWithKey
+# Priority queue
+import heapq
+from itertools import count, islice
 
 # Progress bar
-from tqdm import trange
+from tqdm import tqdm
 
 # Binary encoding and compression
 from io import BytesIO
+import struct
 import lzma
 
+# Optional: much faster (de)compression than lzma, at the cost of slightly larger files
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+
+
+# Region statistics
+
+class IntegralImage:
+    """ Summed-area tables of an image that allow computing the statistics of any rectangular region
+    in constant time, independent of the size of the region. """
+
+    def __init__(self, image_data: np.array):
+        height, width, channel_count = image_data.shape
+        self.channel_count = channel_count
+
+        # The channels (e.g. r, g, b) and the squared channels (r^2, g^2, b^2) share one table,
+        # so that it is built in a single pass and a region needs only one lookup per corner.
+        # The table is padded with a leading row and column of zeros,
+        # so that regions touching the top or left border need no special handling.
+        self.sums = np.zeros((height + 1, width + 1, 2 * channel_count), dtype=np.int64)
+        values = self.sums[1:, 1:]
+        values[:, :, :channel_count] = image_data
+        np.square(values[:, :, :channel_count], out=values[:, :, channel_count:])
+        np.cumsum(values, axis=0, out=values)
+        np.cumsum(values, axis=1, out=values)
+
+    def _region_sums(self, x: int, y: int, width: int, height: int) -> list:
+        end_x = x + width
+        end_y = y + height
+        sums = self.sums
+        return (sums[end_y, end_x] - sums[y, end_x] - sums[end_y, x] + sums[y, x]).tolist()
+
+    def compute_region_statistics(self, position: tuple, size: tuple) -> tuple:
+        """ Computes the detail and the average color of an image region.
+
+        The detail is the sum of the standard deviation of each channel (e.g. RGB) weighted by the number of values
+        in this region.
+        :return: Tuple (detail, color)
+        """
+        x, y = position
+        width, height = size
+        pixel_count = width * height
+
+        channel_count = self.channel_count
+        region_sums = self._region_sums(x, y, width, height)
+        channel_sums = region_sums[:channel_count]
+
+        standard_deviation_sum = 0.0
+        for channel_sum, channel_squared_sum in zip(channel_sums, region_sums[channel_count:]):
+            mean = channel_sum / pixel_count
+            variance = channel_squared_sum / pixel_count - mean * mean
+            standard_deviation_sum += math.sqrt(max(variance, 0))
+
+        # (pixel_count * channel_count is the number of values in the region)
+        detail = standard_deviation_sum * pixel_count * channel_count
+        color = tuple(channel_sum // pixel_count for channel_sum in channel_sums)
+        return detail, color
+
+    def compute_statistics_of_regions(self, x: np.array, y: np.array, width: np.array, height: np.array) -> tuple:
+        """ Vectorized version of compute_region_statistics for many regions at once.
+        :return: Tuple (details, colors) where colors has the shape (region count, channel count)
+        """
+        channel_count = self.channel_count
+        end_x = x + width
+        end_y = y + height
+        pixel_count = width * height
+
+        region_sums = self.sums[end_y, end_x] - self.sums[y, end_x] - self.sums[end_y, x] + self.sums[y, x]
+        channel_sums = region_sums[:, :channel_count]
+        channel_squared_sums = region_sums[:, channel_count:]
+
+        mean = channel_sums / pixel_count[:, np.newaxis]
+        variance = channel_squared_sums / pixel_count[:, np.newaxis] - mean * mean
+        standard_deviation = np.sqrt(np.maximum(variance, 0))
+        standard_deviation_sum = standard_deviation.sum(axis=1)
+
+        details = standard_deviation_sum * pixel_count * channel_count
+        colors = channel_sums // pixel_count[:, np.newaxis]
+        return details, colors
+
 
 # QuadTree data structures
 
 class QuadTreeNode:
     """ Base quad tree data structure that handles the positioning, subdivision and rendering of nodes. """
 
+    # Storing the attributes in slots instead of a per-instance dict saves memory
+    # and speeds up attribute access, as large trees consist of hundreds of thousands of nodes.
+    __slots__ = (
+        "position", "size", "color", "is_subdivided",
+        "bottom_left_node", "bottom_right_node", "top_left_node", "top_right_node"
+    )
+
     def __init__(self, position: tuple, size: tuple):
         self.position = position
         self.size = size
@@ -34,50 +127,54 @@ class QuadTreeNode:
     def _create_child_node(self, position, size):
         return QuadTreeNode(position, size)
 
-    def subdivide(self):
-        """ Splits the current quad into 4 child quads if this is possible.
-        :return: Child quads or None or an empty list if it cannot be further subdivided.
-        """
-        if self.is_subdivided:
-            return []
+    def can_subdivide(self) -> bool:
+        width, height = self.size
+        return not self.is_subdivided and width > 1 and height > 1
 
+    def get_child_regions(self) -> tuple:
+        """ Computes the regions that the child quads cover when this quad is subdivided.
+        :return: (position, size) of the bottom left, bottom right, top left and top right child quads.
+        """
         width, height = self.size
         x, y = self.position
 
-        if width <= 1 or height <= 1:
-            return []
-
-        self.is_subdivided = True
-
         split_width = width // 2
         split_height = height // 2
 
-        self.bottom_left_node = self._create_child_node(
-            (x, y),
-            (split_width, split_height))
-
-        self.bottom_right_node = self._create_child_node(
-            (x + split_width, y),
-            (width - split_width, split_height))
+        return (
+            ((x, y), (split_width, split_height)),
+            ((x + split_width, y), (width - split_width, split_height)),
+            ((x, y + split_height), (split_width, height - split_height)),
+            ((x + split_width, y + split_height), (width - split_width, height - split_height))
+        )
 
-        self.top_left_node = self._create_child_node(
-            (x, y + split_height),
-            (split_width, height - split_height))
+    def subdivide(self):
+        """ Splits the current quad into 4 child quads if this is possible.
+        :return: Child quads or None or an empty list if it cannot be further subdivided.
+        """
+        if not self.can_subdivide():
+            return []
 
-        self.top_right_node = self._create_child_node(
-            (x + split_width, y + split_height),
-            (width - split_width, height - split_height))
+        return self._set_child_nodes([
+            self._create_child_node(position, size)
+            for position, size in self.get_child_regions()
+        ])
 
+    def _set_child_nodes(self, child_nodes) -> tuple:
+        self.is_subdivided = True
+        self.bottom_left_node, self.bottom_right_node, self.top_left_node, self.top_right_node = child_nodes
         return self.bottom_left_node, self.bottom_right_node, self.top_left_node, self.top_right_node
 
     def draw(self, image_data: np.array):
-        if self.is_subdivided:
-            self.bottom_left_node.draw(image_data)
-            self.bottom_right_node.draw(image_data)
-            self.top_left_node.draw(image_data)
-            self.top_right_node.draw(image_data)
-        else:
-            self.draw_self(image_data)
+        # Iterative traversal using an explicit stack instead of recursing into every node.
+        # (The order does not matter as the leaf nodes do not overlap.)
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node.is_subdivided:
+                stack += (node.bottom_left_node, node.bottom_right_node, node.top_left_node, node.top_right_node)
+            else:
+                node.draw_self(image_data)
 
     def draw_self(self, image_data: np.array):
         if self.color is None:
@@ -89,135 +186,295 @@ class QuadTreeNode:
         image_data[start_y: end_y, start_x: end_x] = self.color
 
     def use_average_leaf_color(self):
-        if not self.is_subdivided:
-            return
-
-        self.bottom_left_node.use_average_leaf_color()
-        self.bottom_right_node.use_average_leaf_color()
-        self.top_left_node.use_average_leaf_color()
-        self.top_right_node.use_average_leaf_color()
-
-        self.color = tuple(np.mean([
-            self.bottom_left_node.color,
-            self.bottom_right_node.color,
-            self.top_left_node.color,
-            self.top_right_node.color
-        ], axis=0))
+        # Every node is added to this list before its children, so going through the list
+        # in reverse updates the children of each node before the node itself.
+        subdivided_nodes = []
+
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node.is_subdivided:
+                subdivided_nodes.append(node)
+                stack += (node.bottom_left_node, node.bottom_right_node, node.top_left_node, node.top_right_node)
+
+        for node in reversed(subdivided_nodes):
+            # Averaging the 4 colors in plain Python is much faster than calling np.mean() on such small arrays.
+            node.color = tuple(
+                (c1 + c2 + c3 + c4) / 4
+                for c1, c2, c3, c4 in zip(
+                    node.bottom_left_node.color,
+                    node.bottom_right_node.color,
+                    node.top_left_node.color,
+                    node.top_right_node.color)
+            )
 
 
 class CompressNode (QuadTreeNode):
     """ QuadTree node used for incrementally compressing an image. """
 
-    def __init__(self, position, image_data: np.array):
-        height, width, _ = image_data.shape
-        super().__init__(position, (width, height))
+    __slots__ = ("_integral_image", "_compressor", "detail")
+
+    def __init__(
+            self,
+            position,
+            size,
+            integral_image: IntegralImage,
+            statistics: tuple = None,
+            compressor: "ImageCompressor" = None):
+
+        super().__init__(position, size)
 
-        self.image_data = image_data
+        # The statistics are looked up in the summed-area tables that are shared by all nodes,
+        # so no node has to keep a view of the image data.
+        self._integral_image = integral_image
+        # The ImageCompressor that owns the tree (if any) keeps track of its size and of the nodes to draw.
+        self._compressor = compressor
 
-        # Compute the detail as the sum of the standard deviation of each channel (RGB)
-        # weighted by the number of pixels in this region.
-        self.detail = np.sum(np.std(image_data, axis=(0, 1))) * self.image_data.size
+        if statistics is None:
+            statistics = integral_image.compute_region_statistics(position, size)
+        self.detail, self.color = statistics
 
-        self.color = np.mean(image_data, axis=(0, 1)).astype(np.uint8)
+    def get_max_child_detail(self) -> float:
+        """ Computes an upper bound for the detail of the child quads of this quad.
+
+        For each channel, the variance of a child weighted by its pixel count cannot exceed the weighted variance
+        of the parent. Therefore a child with the pixel count a has at most the detail detail * sqrt(a / area).
+        """
+        if not self.can_subdivide():
+            return 0
+
+        width, height = self.size
+        max_child_pixel_count = (width - width // 2) * (height - height // 2)
+        # The small margin keeps this an upper bound despite floating point rounding errors.
+        return self.detail * math.sqrt(max_child_pixel_count / (width * height)) * (1 + 1e-9)
 
     def _create_child_node(self, position, size):
-        width, height = size
-        child_x, child_y = position
-        own_x, own_y = self.position
+        return CompressNode(position, size, self._integral_image, compressor=self._compressor)
+
+    def _set_child_nodes(self, child_nodes) -> tuple:
+        child_nodes = super()._set_child_nodes(child_nodes)
+        # Nodes can also be subdivided directly (e.g. via ImageCompressor.root_node), not only by add_detail().
+        if self._compressor is not None:
+            self._compressor._on_subdivided(child_nodes)
+        return child_nodes
+
+    def extract_data(self, subdivided_flags: np.array, colors: np.array) -> tuple:
+        """ Writes the is_subdivided flags of all nodes in this subtree (in preorder) and the colors of its
+        leaf nodes into the given preallocated arrays.
+        :return: Number of flags and number of colors written.
+        """
+        flag_index = 0
+        color_index = 0
 
-        start_x = child_x - own_x
-        start_y = child_y - own_y
-        return CompressNode(position, self.image_data[start_y: start_y + height, start_x: start_x + width])
+        # Iterative preorder traversal, which avoids a Python function call per node
+        # and is not limited by the recursion depth.
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            subdivided_flags[flag_index] = node.is_subdivided
+            flag_index += 1
 
-    def subdivide(self):
-        nodes = super().subdivide()
-        # Memory of the image is no longer needed as the relevant areas
-        # have been passed on to the child nodes.
-        self.image_data = None
-        return nodes
+            if node.is_subdivided:
+                # Pushed in reverse, so that the bottom left node is visited first.
+                stack += (node.top_right_node, node.top_left_node, node.bottom_right_node, node.bottom_left_node)
+            else:
+                colors[color_index] = node.color
+                color_index += 1
 
-    def extract_data(self, subdivided_flags, colors):
-        subdivided_flags.append(self.is_subdivided)
+        return flag_index, color_index
 
-        if self.is_subdivided:
-            self.bottom_left_node.extract_data(subdivided_flags, colors)
-            self.bottom_right_node.extract_data(subdivided_flags, colors)
-            self.top_left_node.extract_data(subdivided_flags, colors)
-            self.top_right_node.extract_data(subdivided_flags, colors)
-        else:
-            r, g, b = self.color
-            colors.append((int(r), int(g), int(b)))
+
+class _Cursor:
+    """ Read position in the decoded subdivided_flags and colors, shared by all nodes of the tree being
+    reconstructed.
+    """
+
+    __slots__ = ("subdivided_flags", "colors", "flag_index", "color_index")
+
+    def __init__(self, subdivided_flags: list, colors: list):
+        self.subdivided_flags = subdivided_flags
+        self.colors = colors
+        self.flag_index = 0
+        self.color_index = 0
 
 
 class ReconstructNode (QuadTreeNode):
     """ QuadTree node for reconstructing a compressed image. """
 
-    def __init__(self, position, size, subdivided_flags: list, colors: list):
+    __slots__ = ("_cursor",)
+
+    def __init__(self, position, size, cursor: _Cursor):
         super().__init__(position, size)
 
-        # Hint:
-        # subdivided_flags and colors must be reversed!
-        # (Improves performance, as popping a value off the back is faster than removing from the front)
+        self._cursor = cursor
 
-        self._subdivided_flags = subdivided_flags
-        self._colors = colors
+        is_subdivided = cursor.subdivided_flags[cursor.flag_index]
+        cursor.flag_index += 1
 
-        is_subdivided = subdivided_flags.pop()
         if is_subdivided:
             self.subdivide()
         else:
-            self.color = colors.pop()
+            self.color = tuple(cursor.colors[cursor.color_index])
+            cursor.color_index += 1
 
     def _create_child_node(self, position, size):
-        return ReconstructNode(position, size, self._subdivided_flags, self._colors)
+        return ReconstructNode(position, size, self._cursor)
 
 
 class ImageCompressor:
     """ Helper class that manages the CompressNodes and allows you to incrementally add detail. """
 
     def __init__(self, image_data: np.array):
-        self.areas = SortedListWithKey(key=lambda node: node.detail)
+        # Binary max-heap of the nodes that can still be subdivided.
+        # The entries are (-detail, insertion index, node) tuples: heapq is a min-heap, and the
+        # unique insertion index resolves ties without ever comparing the nodes themselves.
+        # The index decreases so that, among nodes with the same detail, the most recently added one
+        # is subdivided first (like the pop() of the sorted list this heap replaces).
+        self.areas = []
+        self._insertion_counter = count(0, -1)
         self._image_shape = image_data.shape
         self.height, self.width, _ = self._image_shape
 
-        self.root_node = CompressNode((0, 0), image_data)
-        self.areas.add(self.root_node)
+        self.integral_image = IntegralImage(image_data)
+        self.root_node = CompressNode((0, 0), (self.width, self.height), self.integral_image, compressor=self)
+        self._add_area(self.root_node)
+
+        # The simplified image is only created by the first call to draw() (encoding does not need it).
+        # After that it is updated incrementally: only the nodes that have been created
+        # since the last call to draw() have to be drawn on top of it.
+        self._image_data = None
+        self._nodes_to_draw = None
+
+        # Size of the tree, which determines the size of the binary representation.
+        self.node_count = 1
+        self.leaf_count = 1
+
+    def _add_area(self, node: CompressNode):
+        heapq.heappush(self.areas, (-node.detail, next(self._insertion_counter), node))
+
+    def _on_subdivided(self, child_nodes: tuple):
+        # Each subdivision turns a leaf into an inner node with 4 leaves.
+        self.node_count += 4
+        self.leaf_count += 3
+        if self._nodes_to_draw is not None:
+            self._nodes_to_draw.extend(child_nodes)
 
     def add_detail(self, max_iterations: int = 1, detail_error_threshold: float = 100):
         iterations = 0
 
-        for i in trange(max_iterations, leave=False):
-            if not self.areas:
-                break
+        with tqdm(total=max_iterations, leave=False) as progress:
+            while iterations < max_iterations and self.areas:
+                nodes = self._pop_nodes_with_most_detail(max_iterations - iterations)
+                self._subdivide_nodes(nodes, detail_error_threshold)
+
+                iterations += len(nodes)
+                progress.update(len(nodes))
 
-            node_with_most_detail = self.areas.pop()
-            for node in node_with_most_detail.subdivide():
-                if node.detail > detail_error_threshold:
-                    self.areas.add(node)
+    def _pop_nodes_with_most_detail(self, max_count: int) -> list:
+        """ Pops the nodes that would be subdivided one after the other in the next iterations.
 
-            if i > max_iterations:
+        As the children of a node always have less detail than their parent, the next nodes on the heap
+        can be taken as well as long as they have more detail than any of the children of the nodes taken so far.
+        Subdividing these nodes at once leads to the same result as subdividing them one by one.
+        (A node with the same detail as a child could not be taken, as the newer child would win the tie.)
+        """
+        nodes = []
+        max_child_detail = 0
+
+        while self.areas and len(nodes) < max_count:
+            neg_detail, _, node = self.areas[0]
+            if nodes and -neg_detail <= max_child_detail:
                 break
 
+            heapq.heappop(self.areas)
+            nodes.append(node)
+            max_child_detail = max(max_child_detail, node.get_max_child_detail())
+
+        return nodes
+
+    def _subdivide_nodes(self, nodes: list, detail_error_threshold: float):
+        nodes = [node for node in nodes if node.can_subdivide()]
+        if not nodes:
+            return
+
+        # Computing the regions and statistics of all child nodes in one go is much faster than one call per node.
+        x, y, width, height = np.array([(*node.position, *node.size) for node in nodes], dtype=np.int64).T
+        split_width = width // 2
+        split_height = height // 2
+
+        # Same layout as in QuadTreeNode.get_child_regions(): bottom left, bottom right, top left, top right
+        # (4 consecutive entries per node).
+        children_x = np.stack((x, x + split_width, x, x + split_width), axis=1).ravel()
+        children_y = np.stack((y, y, y + split_height, y + split_height), axis=1).ravel()
+        children_width = np.stack(
+            (split_width, width - split_width, split_width, width - split_width), axis=1).ravel()
+        children_height = np.stack(
+            (split_height, split_height, height - split_height, height - split_height), axis=1).ravel()
+
+        details, colors = self.integral_image.compute_statistics_of_regions(
+            children_x, children_y, children_width, children_height)
+
+        child_nodes_data = zip(
+            zip(children_x.tolist(), children_y.tolist()),
+            zip(children_width.tolist(), children_height.tolist()),
+            details.tolist(),
+            colors.tolist())
+
+        for node in nodes:
+            child_nodes = node._set_child_nodes([
+                CompressNode(position, size, self.integral_image, (detail, tuple(color)), self)
+                for position, size, detail, color in islice(child_nodes_data, 4)
+            ])
+
+            for child_node in child_nodes:
+                if child_node.detail > detail_error_threshold:
+                    self._add_area(child_node)
+
     def draw(self):
-        new_image_data = np.zeros(self._image_shape, dtype=np.uint8)
-        self.root_node.draw(new_image_data)
-        return new_image_data
+        if self._image_data is None:
+            self._image_data = np.zeros(self._image_shape, dtype=np.uint8)
+            self.root_node.draw(self._image_data)
+            self._nodes_to_draw = []
+        else:
+            # The children of a subdivided node completely cover it, so it does not have to be drawn.
+            for node in self._nodes_to_draw:
+                if not node.is_subdivided:
+                    node.draw_self(self._image_data)
+            self._nodes_to_draw.clear()
+
+        return self._image_data.copy()
 
     def extract_data(self):
-        subdivided_flags = []
-        colors = []
+        subdivided_flags = np.empty(self.node_count, dtype=bool)
+        colors = np.empty((self.leaf_count, self.integral_image.channel_count), dtype=np.uint8)
 
-        self.root_node.extract_data(subdivided_flags, colors)
+        flag_count, color_count = self.root_node.extract_data(subdivided_flags, colors)
+        # Otherwise parts of the arrays would be left uninitialised.
+        assert flag_count == self.node_count and color_count == self.leaf_count
 
         return subdivided_flags, colors
 
-    def encode_to_binary(self) -> bytes:
+    def encode_to_binary(self, compression: str = "lzma") -> bytes:
         subdivided_flags, colors = self.extract_data()
-        return encode_image_data(self.width, self.height, subdivided_flags, colors)
+        return encode_image_data(self.width, self.height, subdivided_flags, colors, compression)
+
+    def get_uncompressed_binary_size(self) -> int:
+        """ Computes the size of the binary representation before the general-purpose compression without
+        encoding the tree (see encode_image_data). The size returned by encode_to_binary() is usually smaller.
+        :return: Size in bytes
+        """
+        header_size = IMAGE_HEADER.size
+        bitset_size = 4 + math.ceil(self.node_count / 8)
+        colors_size = 3 * self.leaf_count
+        return header_size + bitset_size + colors_size
 
 
 # Encoding / Decoding
 
+# Width and height of the image (2 * uint32, little endian)
+IMAGE_HEADER = struct.Struct("<II")
+
+
 def encode_uint32(number: int) -> bytes:
     return number.to_bytes(4, byteorder="little", signed=False)
 
@@ -240,75 +497,82 @@ def encode_bitset(boolean_flags: list, stream: BytesIO):
 
     # Encode the booleans
     # As each boolean only needs one bit, 8 booleans can be densely packed into a single byte.
-    byte_count = math.ceil(len(boolean_flags) / 8)
-    for byte_index in range(byte_count):
-        byte = 0
-
-        for bit_index in range(8):
-            list_index = byte_index * 8 + bit_index
-            if list_index >= len(boolean_flags) or not boolean_flags[list_index]:
-                continue
-            # Fill the byte from left to right
-            byte |= 1 << bit_index
-
-        stream.write(encode_uint8(byte))
+    # Each byte is filled from the least significant bit to the most significant bit.
+    flags = np.asarray(boolean_flags, dtype=bool)
+    stream.write(np.packbits(flags, bitorder="little").tobytes())
 
 
 def decode_bitset(stream: BytesIO) -> list:
     flag_count = decode_uint32(stream.read(4))
-    boolean_flags = []
 
     byte_count = math.ceil(flag_count / 8)
-    for byte_index in range(byte_count):
-        byte = decode_uint8(stream.read(1))
+    packed_flags = np.frombuffer(stream.read(byte_count), dtype=np.uint8)
+    # The padding bits of the last byte are cut off by the count.
+    boolean_flags = np.unpackbits(packed_flags, count=flag_count, bitorder="little").astype(bool)
+
+    return boolean_flags.tolist()
+
+
+# Both formats can be told apart by the magic number at the start of the compressed data.
+ZSTD_MAGIC_NUMBER = b"\x28\xb5\x2f\xfd"
+
+
+def compress_bytes(data: bytes, compression: str = "lzma") -> bytes:
+    if compression == "lzma":
+        return lzma.compress(data)
 
-        for bit_index in range(8):
-            list_index = byte_index * 8 + bit_index
-            if list_index >= flag_count:
-                continue
+    if compression == "zstd":
+        if not ZSTD_AVAILABLE:
+            raise ImportError("zstd compression requires the 'zstandard' package to be installed")
+        return zstandard.ZstdCompressor(level=19).compress(data)
 
-            boolean_flags.append((byte & (1 << bit_index)) > 0)
+    raise ValueError(f"Unknown compression: {compression!r} (expected 'lzma' or 'zstd')")
 
-    return boolean_flags
 
+def decompress_bytes(data: bytes) -> bytes:
+    if data.startswith(ZSTD_MAGIC_NUMBER):
+        if not ZSTD_AVAILABLE:
+            raise ImportError("Decoding zstd compressed data requires the 'zstandard' package to be installed")
+        return zstandard.ZstdDecompressor().decompress(data)
+
+    return lzma.decompress(data)
+
+
+def encode_image_data(
+        width: int,
+        height: int,
+        subdivided_flags: list,
+        colors: list,
+        compression: str = "lzma") -> bytes:
 
-def encode_image_data(width: int, height: int, subdivided_flags: list, colors: list) -> bytes:
     stream = BytesIO()
     # Encode the image dimensions.
-    stream.write(encode_uint32(width))
-    stream.write(encode_uint32(height))
+    stream.write(IMAGE_HEADER.pack(width, height))
 
     # Encode the is_subdivided flags.
     encode_bitset(subdivided_flags, stream)
 
-    # Encode the colors.
-    for color in colors:
-        r, g, b = color
-        stream.write(encode_uint8(r))
-        stream.write(encode_uint8(g))
-        stream.write(encode_uint8(b))
+    # Encode the colors (3 consecutive bytes per color: r, g, b).
+    colors = np.asarray(colors, dtype=np.uint8)
+    if colors.ndim != 2 or colors.shape[1] != 3:
+        raise ValueError(f"The binary format only supports RGB colors, got colors of shape {colors.shape}")
+    stream.write(colors.tobytes())
 
     blob = stream.getvalue()
-    return lzma.compress(blob)
+    return compress_bytes(blob, compression)
 
 
 def decode_image_data(compressed: bytes) -> tuple:
-    stream = BytesIO(lzma.decompress(compressed))
+    stream = BytesIO(decompress_bytes(compressed))
 
-    width = decode_uint32(stream.read(4))
-    height = decode_uint32(stream.read(4))
+    width, height = IMAGE_HEADER.unpack(stream.read(IMAGE_HEADER.size))
 
     subdivided_flags = decode_bitset(stream)
 
     # Only the leaf nodes (nodes that are not subdivided => flag is False) can draw a color
-    color_count = sum(0 if flag else 1 for flag in subdivided_flags)
-    colors = []
-
-    for i in range(color_count):
-        r = decode_uint8(stream.read(1))
-        g = decode_uint8(stream.read(1))
-        b = decode_uint8(stream.read(1))
-        colors.append((r, g, b))
+    color_count = len(subdivided_flags) - sum(subdivided_flags)
+    # Array of shape (color_count, 3)
+    colors = np.frombuffer(stream.read(3 * color_count), dtype=np.uint8).reshape(-1, 3)
 
     return width, height, subdivided_flags, colors
 
@@ -328,44 +592,77 @@ def compress_image_data(
 def compress_and_encode_image_data(
         image_data: np.array,
         iterations: int = 20000,
-        detail_error_threshold: float = 10) -> bytes:
+        detail_error_threshold: float = 10,
+        compression: str = "lzma") -> bytes:
 
     compressor = ImageCompressor(image_data)
     compressor.add_detail(iterations, detail_error_threshold)
-    return compressor.encode_to_binary()
+    return compressor.encode_to_binary(compression)
 
 
 def reconstruct_quadtree(data: bytes) -> ReconstructNode:
     width, height, subdivided_flags, colors = decode_image_data(data)
 
-    # The ReconstructNode requires these to be reversed for performance reasons.
-    subdivided_flags = list(reversed(subdivided_flags))
-    colors = list(reversed(colors))
+    cursor = _Cursor(subdivided_flags, colors.tolist())
+    return ReconstructNode((0, 0), (width, height), cursor)
+
 
+def draw_image_data(width: int, height: int, subdivided_flags: list, colors: np.array) -> np.array:
+    """ Draws the leaf nodes of the encoded quadtree directly, without constructing the actual tree.
+    :param subdivided_flags: is_subdivided flags of the nodes in preorder (see CompressNode.extract_data)
+    :param colors: Colors of the leaf nodes in preorder
+    """
     image_data = np.zeros((height, width, 3), dtype=np.uint8)
-    return ReconstructNode((0, 0), (width, height), subdivided_flags, colors)
+    colors = colors.tolist()
 
+    color_index = 0
+    # (x, y, width, height) of the nodes that still have to be visited.
+    stack = [(0, 0, width, height)]
 
-def reconstruct_image_data(data: bytes) -> np.array:
-    tree = reconstruct_quadtree(data)
-    width, height = tree.size
+    for is_subdivided in subdivided_flags:
+        x, y, width, height = stack.pop()
+
+        if is_subdivided:
+            split_width = width // 2
+            split_height = height // 2
+            # Same regions as in QuadTreeNode.get_child_regions(), pushed in reverse order
+            # so that the bottom left node is visited first.
+            stack.append((x + split_width, y + split_height, width - split_width, height - split_height))
+            stack.append((x, y + split_height, split_width, height - split_height))
+            stack.append((x + split_width, y, width - split_width, split_height))
+            stack.append((x, y, split_width, split_height))
+        else:
+            image_data[y: y + height, x: x + width] = colors[color_index]
+            color_index += 1
 
-    image_data = np.zeros((height, width, 3), dtype=np.uint8)
-    tree.draw(image_data)
     return image_data
 
+
+def reconstruct_image_data(data: bytes) -> np.array:
+    return draw_image_data(*decode_image_data(data))
+
 # Simpler API
 
+def load_image_data(image_path: str) -> np.array:
+    """ Loads an image in the format expected by the compressor (height x width x 3 channels of uint8). """
+    image = Image.open(image_path)
+    # convert() would copy the image even if it is already RGB.
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    # Unlike np.array(), np.asarray() does not make another copy of the pixel data.
+    # (The returned array is read-only.)
+    return np.asarray(image)
+
+
 def compress_image_file(
         image_path: str,
         output_path: str,
         iterations: int = 20000,
-        detail_error_threshold: float = 10):
-
-    image = Image.open(image_path)
-    image_data = np.array(image)
+        detail_error_threshold: float = 10,
+        compression: str = "lzma"):
 
-    data = compress_and_encode_image_data(image_data, iterations, detail_error_threshold)
+    image_data = load_image_data(image_path)
+    data = compress_and_encode_image_data(image_data, iterations, detail_error_threshold, compression)
 
     with open(output_path, "wb") as file:
         file.write(data)